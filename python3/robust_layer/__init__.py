@@ -35,9 +35,43 @@ __author__ = "fpemud@sina.com (Fpemud)"
 __version__ = "0.0.1"
 
 
+import os
+
+
 # general timeout
 # for not-continuable operation, operation itself should have separate timeout so that the connection is kept as long as possible
 TIMEOUT = 10
 
+# learn timeout for each host from the silent periods between outputs of successful operations (like TCP retransmission timeout)
+# TIMEOUT is used for hosts not learned yet, learned timeout is bounded by ADAPTIVE_TIMEOUT_MIN and ADAPTIVE_TIMEOUT_MAX
+ADAPTIVE_TIMEOUT = False
+ADAPTIVE_TIMEOUT_MIN = 3
+ADAPTIVE_TIMEOUT_MAX = 300
+
 # wait 1 seconds between retries
 RETRY_WAIT = 1
+
+# bandwidth limit in bytes per second, shared by all the concurrent operations of all processes, 0 means no limit
+# each operation gets an equal share of the operations running when it starts
+BANDWIDTH_LIMIT = 0
+BANDWIDTH_LIMIT_PER_HOST = 0
+
+# max number of concurrent network operations of all processes, 0 means no limit
+MAX_CONNECTIONS = 0
+MAX_CONNECTIONS_PER_HOST = 0
+
+# git operations over ssh share a master connection for each host, the master exits after being idle for SSH_PERSIST seconds
+# it has no effect if GIT_SSH or GIT_SSH_COMMAND is set by user
+SSH_MULTIPLEX = False
+SSH_PERSIST = 60
+
+# directories to be deleted are moved into a trash directory and deleted in background, used by re-clone and re-checkout
+BACKGROUND_DELETE = False
+
+# run incremental maintenance in background for repositories updated by robust_layer.git and robust_layer.simple_git
+# see robust_layer.git_maintenance, at most GIT_MAINTENANCE_JOBS of them are running in all processes
+GIT_MAINTENANCE = False
+GIT_MAINTENANCE_JOBS = 1
+
+# directory for persistent states shared by all the processes
+STATE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "robust_layer")
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# _ssh.py - ssh connection multiplexing
+#
+# Copyright (c) 2019-2020 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import shlex
+import tempfile
+import subprocess
+import urllib.parse
+from . import TIMEOUT
+
+
+SOCKET_DIR = os.path.join(tempfile.gettempdir(), "robust_layer-ssh-%d" % (os.getuid()))
+
+
+def environ():
+    # returns environment variables which make git use ssh with ControlMaster
+    from . import SSH_MULTIPLEX, SSH_PERSIST
+
+    if not SSH_MULTIPLEX or "GIT_SSH" in os.environ or "GIT_SSH_COMMAND" in os.environ:
+        return dict()
+    if not _prepareSocketDir():
+        return dict()
+    return {
+        "GIT_SSH_COMMAND": " ".join(["/usr/bin/ssh"] + [shlex.quote(x) for x in _options(SSH_PERSIST)]),
+    }
+
+
+def checkMaster(url):
+    # a hung master connection is stopped so that a new one would be created by the next operation
+    # it is a no-op if there's no master connection, or url is not a ssh url
+    from . import SSH_PERSIST
+
+    if environ() == dict():
+        return
+    dest = _urlGetSshDest(url)
+    if dest is None:
+        return
+
+    try:
+        subprocess.run(["/usr/bin/ssh"] + _options(SSH_PERSIST) + ["-O", "check"] + dest,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=TIMEOUT)
+    except subprocess.TimeoutExpired:
+        try:
+            subprocess.run(["/usr/bin/ssh"] + _options(SSH_PERSIST) + ["-O", "exit"] + dest,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=TIMEOUT)
+        except subprocess.TimeoutExpired:
+            pass
+
+
+def _options(persist):
+    # keep-alive makes the master connection exit when network is down, so it won't be reused
+    return [
+        "-o", "ControlMaster=auto",
+        "-o", "ControlPath=%s" % (os.path.join(SOCKET_DIR, "%C")),
+        "-o", "ControlPersist=%d" % (persist),
+        "-o", "ServerAliveInterval=%d" % (TIMEOUT),
+        "-o", "ServerAliveCountMax=3",
+    ]
+
+
+def _prepareSocketDir():
+    # socket directory must be private, or else other users would be able to use our connections
+    try:
+        os.makedirs(SOCKET_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(SOCKET_DIR)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and (st.st_mode & 0o077) == 0 and os.path.isdir(SOCKET_DIR) and not os.path.islink(SOCKET_DIR)
+
+
+def _urlGetSshDest(url):
+    # returns ssh command line arguments specifying the destination, or None if url is not a ssh url
+    # "ssh://[user@]host[:port]/path", "git+ssh://..." and "[user@]host:path" (scp-like syntax) are recognized
+    if "://" in url:
+        r = urllib.parse.urlparse(url)
+        if r.scheme not in ["ssh", "git+ssh", "ssh+git"] or r.hostname is None:
+            return None
+        ret = []
+        if r.port is not None:
+            ret += ["-p", str(r.port)]
+        if r.username is not None:
+            ret += ["-l", r.username]
+        return ret + [r.hostname]
+
+    if url.startswith("/") or ":" not in url.split("/")[0]:
+        return None
+    userHost = url.split(":")[0]
+    if "@" in userHost:
+        user, host = userHost.rsplit("@", 1)
+        return ["-l", user, host]
+    return [userHost]
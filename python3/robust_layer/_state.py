@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# _state.py - persistent states
+#
+# Copyright (c) 2019-2020 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import sqlite3
+
+
+class StateDb:
+
+    # persistent states shared by all the processes, stored in a sqlite database in STATE_DIR
+    # directory paths are stored as absolute paths
+
+    def __init__(self):
+        from . import STATE_DIR
+
+        os.makedirs(STATE_DIR, exist_ok=True)
+        self._conn = sqlite3.connect(os.path.join(STATE_DIR, "state.db"), timeout=60)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS sync_state (dest TEXT PRIMARY KEY, url TEXT, ref TEXT, head TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS http_validators (url TEXT, dest TEXT, etag TEXT, last_modified TEXT, size INTEGER, PRIMARY KEY (url, dest))")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS git_maintenance (dest TEXT PRIMARY KEY, pulls INTEGER)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS host_timeout (host TEXT PRIMARY KEY, srtt REAL, rttvar REAL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS trash_dir (path TEXT PRIMARY KEY)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._conn.close()
+
+    def getSyncState(self, dest):
+        # returns (url, ref, head) recorded when dest was last synced, or None
+        cur = self._conn.execute("SELECT url, ref, head FROM sync_state WHERE dest = ?", (os.path.abspath(dest),))
+        return cur.fetchone()
+
+    def setSyncState(self, dest, url, ref, head):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?, ?)", (os.path.abspath(dest), url, ref, head))
+
+    def removeSyncState(self, dest):
+        with self._conn:
+            self._conn.execute("DELETE FROM sync_state WHERE dest = ?", (os.path.abspath(dest),))
+
+    def getHttpValidators(self, url, dest):
+        # returns (etag, last_modified, size) of dest when it was last downloaded from url, or None
+        cur = self._conn.execute("SELECT etag, last_modified, size FROM http_validators WHERE url = ? AND dest = ?", (url, os.path.abspath(dest)))
+        return cur.fetchone()
+
+    def setHttpValidators(self, url, dest, etag, last_modified, size):
+        with self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO http_validators VALUES (?, ?, ?, ?, ?)", (url, os.path.abspath(dest), etag, last_modified, size))
+
+    def removeHttpValidators(self, url, dest):
+        with self._conn:
+            self._conn.execute("DELETE FROM http_validators WHERE url = ? AND dest = ?", (url, os.path.abspath(dest)))
+
+    def increaseGitPullCount(self, dest):
+        # returns the pull count since last maintenance
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO git_maintenance VALUES (?, 0)", (os.path.abspath(dest),))
+            self._conn.execute("UPDATE git_maintenance SET pulls = pulls + 1 WHERE dest = ?", (os.path.abspath(dest),))
+            return self._conn.execute("SELECT pulls FROM git_maintenance WHERE dest = ?", (os.path.abspath(dest),)).fetchone()[0]
+
+    def resetGitPullCount(self, dest):
+        with self._conn:
+            self._conn.execute("DELETE FROM git_maintenance WHERE dest = ?", (os.path.abspath(dest),))
+
+    def getHostTimeout(self, host):
+        # returns (srtt, rttvar) of host, or None
+        return self._conn.execute("SELECT srtt, rttvar FROM host_timeout WHERE host = ?", (host,)).fetchone()
+
+    def updateHostTimeout(self, host, sample):
+        # same algorithm as TCP retransmission timeout (RFC 6298)
+        with self._conn:
+            row = self._conn.execute("SELECT srtt, rttvar FROM host_timeout WHERE host = ?", (host,)).fetchone()
+            if row is None:
+                srtt, rttvar = sample, sample / 2
+            else:
+                srtt, rttvar = row
+                rttvar = 0.75 * rttvar + 0.25 * abs(srtt - sample)
+                srtt = 0.875 * srtt + 0.125 * sample
+            self._conn.execute("INSERT OR REPLACE INTO host_timeout VALUES (?, ?, ?)", (host, srtt, rttvar))
+
+    def backoffHostTimeout(self, host, timeout):
+        # double the timeout after an operation timed out (RFC 6298 section 5.5), timeout is the one used by the operation
+        with self._conn:
+            row = self._conn.execute("SELECT srtt, rttvar FROM host_timeout WHERE host = ?", (host,)).fetchone()
+            if row is None:
+                srtt, rttvar = timeout * 2 / 3, timeout / 3
+            else:
+                srtt, rttvar = row[0] * 2, row[1] * 2
+            self._conn.execute("INSERT OR REPLACE INTO host_timeout VALUES (?, ?, ?)", (host, srtt, rttvar))
+
+    def getTrashDirs(self):
+        return [x[0] for x in self._conn.execute("SELECT path FROM trash_dir")]
+
+    def addTrashDir(self, path):
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO trash_dir VALUES (?)", (os.path.abspath(path),))
+
+    def removeTrashDir(self, path):
+        with self._conn:
+            self._conn.execute("DELETE FROM trash_dir WHERE path = ?", (os.path.abspath(path),))
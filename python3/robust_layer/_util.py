@@ -23,17 +23,31 @@
 # THE SOFTWARE.
 
 import os
+import re
 import sys
+import stat
+import math
 import time
+import fcntl
 import socket
+import hashlib
+import tempfile
+import itertools
 import shutil
 import selectors
+import threading
 import subprocess
-from . import TIMEOUT
+import urllib.parse
+import concurrent.futures
+from . import TIMEOUT, RETRY_WAIT
+from . import progress
+from ._state import StateDb
 
 
 PARENT_WAIT = 1.0
 
+LOCK_DIR = os.path.join(tempfile.gettempdir(), "robust_layer-locks-%d" % (os.getuid()))
+
 
 class ProcessStuckError(Exception):
 
@@ -54,13 +68,18 @@ class Util:
         return ret
 
     @staticmethod
-    def forceDelete(path):
+    def forceDelete(path, bBackground=None):
+        if bBackground is None:
+            from . import BACKGROUND_DELETE
+            bBackground = BACKGROUND_DELETE
+
         if os.path.islink(path):
             os.remove(path)
         elif os.path.isfile(path):
             os.remove(path)
         elif os.path.isdir(path):
-            shutil.rmtree(path)
+            if not bBackground or not TrashReaper.trash(path):
+                shutil.rmtree(path)
         elif os.path.exists(path):      # FIXME: device node, how to check it?
             os.remove(path)
         else:
@@ -115,26 +134,59 @@ class Util:
         return ret.stdout.rstrip()
 
     @staticmethod
-    def shellExec(cmd, envDict=None):
+    def shellExec(cmd, envDict=None, host=None):
+        # host: the remote host that the command talks to, used to learn timeout, see Util.getTimeout()
         proc = subprocess.Popen(cmd, env=envDict,
                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
                                 shell=True)
-        Util._communicate(proc)
+        return Util._communicate(proc, host)
 
     @staticmethod
-    def cmdListExec(cmdList, envDict=None):
+    def cmdListExec(cmdList, envDict=None, host=None):
         proc = subprocess.Popen(cmdList, env=envDict,
                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        Util._communicate(proc)
+        return Util._communicate(proc, host)
 
     @staticmethod
-    def cmdListExecWithStuckCheck(cmdList, envDict=None, bQuiet=False):
+    def cmdListExecWithStuckCheck(cmdList, envDict=None, bQuiet=False, host=None):
         proc = subprocess.Popen(cmdList, env=envDict,
                                 stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        Util._communicateWithStuckCheck(proc, bQuiet)
+        return Util._communicateWithStuckCheck(proc, bQuiet, host)
+
+    @staticmethod
+    def getTimeout(host):
+        from . import ADAPTIVE_TIMEOUT, ADAPTIVE_TIMEOUT_MIN, ADAPTIVE_TIMEOUT_MAX
+
+        if not ADAPTIVE_TIMEOUT or host is None:
+            return TIMEOUT
+        with StateDb() as db:
+            row = db.getHostTimeout(host)
+        if row is None:
+            return TIMEOUT
+        return math.ceil(min(max(row[0] + 4 * row[1], ADAPTIVE_TIMEOUT_MIN), ADAPTIVE_TIMEOUT_MAX))
+
+    @staticmethod
+    def _learnTimeout(host, maxGap):
+        # only learned from successful operations that output progress continuously
+        # silent operations (such as "quiet" ones) are not learned, the whole run time would be taken as silent period
+        from . import ADAPTIVE_TIMEOUT
+
+        if ADAPTIVE_TIMEOUT and host is not None:
+            with StateDb() as db:
+                db.updateHostTimeout(host, maxGap)
+
+    @staticmethod
+    def _backoffTimeout(host, timeout):
+        # called when operation is stuck, or failed after being silent for the whole timeout (the tool's own timeout expired)
+        # without it, the retry would use the same timeout that is too short, since only successful operations are learned
+        from . import ADAPTIVE_TIMEOUT, ADAPTIVE_TIMEOUT_MAX
+
+        if ADAPTIVE_TIMEOUT and host is not None and timeout < ADAPTIVE_TIMEOUT_MAX:
+            with StateDb() as db:
+                db.backoffHostTimeout(host, timeout)
 
     @staticmethod
-    def _communicate(proc):
+    def _communicate(proc, host=None):
         if hasattr(selectors, 'PollSelector'):
             pselector = selectors.PollSelector
         else:
@@ -143,6 +195,12 @@ class Util:
         # redirect proc.stdout/proc.stderr to stdout/stderr
         # make CalledProcessError contain stdout/stderr content
         sStdout = b''
+        relay = progress._Relay(proc.args)
+        timeout = Util.getTimeout(host)
+        lastTime = time.monotonic()
+        maxSilence = 0
+        maxGap = 0                  # max silence between two outputs, silence before the first output and after the last one is not counted
+        chunkCount = 0
         with pselector() as selector:
             os.set_blocking(proc.stdout.fileno(), False)
             selector.register(proc.stdout, selectors.EVENT_READ)
@@ -153,18 +211,29 @@ class Util:
                     if data == b'':
                         selector.unregister(key.fileobj)
                         continue
+                    maxSilence = max(maxSilence, time.monotonic() - lastTime)
+                    if chunkCount > 0:
+                        maxGap = max(maxGap, time.monotonic() - lastTime)
+                    chunkCount += 1
+                    lastTime = time.monotonic()
                     sStdout += data
-                    sys.stdout.buffer.write(data)
-                    sys.stdout.flush()
+                    relay.feed(data)
+        maxSilence = max(maxSilence, time.monotonic() - lastTime)
 
         retcode = proc.wait()
+        relay.finish(retcode)
         if retcode > 128:
             time.sleep(PARENT_WAIT)
         if retcode != 0:
-            raise subprocess.CalledProcessError(retcode, proc.args, sStdout.decode(sys.stdout.encoding), "")
+            if retcode <= 128 and maxSilence >= timeout:
+                Util._backoffTimeout(host, timeout)
+            raise subprocess.CalledProcessError(retcode, proc.args, sStdout.decode(sys.stdout.encoding, errors="replace"), "")
+        if chunkCount > 1:
+            Util._learnTimeout(host, maxGap)
+        return sStdout.decode(sys.stdout.encoding, errors="replace")
 
     @staticmethod
-    def _communicateWithStuckCheck(proc, bQuiet):
+    def _communicateWithStuckCheck(proc, bQuiet, host=None):
         if hasattr(selectors, 'PollSelector'):
             pselector = selectors.PollSelector
         else:
@@ -174,15 +243,21 @@ class Util:
         # make CalledProcessError contain stdout/stderr content
         sStdout = b''
         bStuck = False
+        relay = progress._Relay(proc.args)
+        timeout = Util.getTimeout(host)
+        lastTime = time.monotonic()
+        maxSilence = 0
+        maxGap = 0                  # max silence between two outputs, silence before the first output and after the last one is not counted
+        chunkCount = 0
         with pselector() as selector:
             os.set_blocking(proc.stdout.fileno(), False)
             selector.register(proc.stdout, selectors.EVENT_READ)
             while selector.get_map():
-                res = selector.select(TIMEOUT)
+                res = selector.select(timeout)
                 if res == []:
                     bStuck = True
                     if not bQuiet:
-                        print("Process stuck for %d second(s), terminated.\n" % (TIMEOUT))
+                        print("Process stuck for %d second(s), terminated.\n" % (timeout))
                     proc.terminate()
                     break
                 for key, events in res:
@@ -190,17 +265,73 @@ class Util:
                     if data == b'':
                         selector.unregister(key.fileobj)
                         continue
+                    maxSilence = max(maxSilence, time.monotonic() - lastTime)
+                    if chunkCount > 0:
+                        maxGap = max(maxGap, time.monotonic() - lastTime)
+                    chunkCount += 1
+                    lastTime = time.monotonic()
                     sStdout += data
-                    sys.stdout.buffer.write(data)
-                    sys.stdout.flush()
+                    relay.feed(data)
+        maxSilence = max(maxSilence, time.monotonic() - lastTime)
 
         retcode = proc.wait()
+        relay.finish(retcode, bStuck)
         if bStuck:
-            raise ProcessStuckError(proc.args, TIMEOUT)
+            Util._backoffTimeout(host, timeout)
+            raise ProcessStuckError(proc.args, timeout)
         if retcode > 128:
             time.sleep(PARENT_WAIT)
         if retcode != 0:
-            raise subprocess.CalledProcessError(retcode, proc.args, sStdout.decode(sys.stdout.encoding), "")
+            if retcode <= 128 and maxSilence >= timeout:
+                Util._backoffTimeout(host, timeout)
+            raise subprocess.CalledProcessError(retcode, proc.args, sStdout.decode(sys.stdout.encoding, errors="replace"), "")
+        if chunkCount > 1:
+            Util._learnTimeout(host, maxGap)
+        return sStdout.decode(sys.stdout.encoding, errors="replace")
+
+    @staticmethod
+    def prepareLockDir():
+        # lock directory must be private, or else other users would be able to hijack our lock files
+        os.makedirs(LOCK_DIR, mode=0o700, exist_ok=True)
+        st = os.lstat(LOCK_DIR)
+        if st.st_uid != os.getuid() or (st.st_mode & 0o077) != 0 or not stat.S_ISDIR(st.st_mode):
+            raise PermissionError("%s is not a private directory" % (LOCK_DIR))
+
+    @staticmethod
+    def urlGetHost(url):
+        # "scheme://[user@]host[:port]/path", "[user@]host:path" (scp-like syntax) and "host::module" (rsync daemon) are recognized
+        if "://" in url:
+            return urllib.parse.urlparse(url).hostname
+        m = re.fullmatch("(?:[^@/]+@)?([^:/]+):.*", url)
+        if m is not None:
+            return m.group(1)
+        return None
+
+    @staticmethod
+    def argsGetHost(args):
+        for x in args:
+            if not x.startswith("-"):
+                ret = Util.urlGetHost(x)
+                if ret is not None:
+                    return ret
+        return None
+
+    @staticmethod
+    def runPerHost(func, argsList, jobs):
+        # call func(*args) for each element of argsList in parallel, args[0] is the url
+        # at most "jobs" calls are running for each host, returns the list of results
+        semDict = dict()
+        for args in argsList:
+            semDict.setdefault(Util.urlGetHost(args[0]), threading.BoundedSemaphore(jobs))
+
+        def _run(args):
+            with semDict[Util.urlGetHost(args[0])]:
+                return func(*args)
+
+        if len(argsList) == 0:
+            return []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs * len(semDict)) as executor:
+            return list(executor.map(_run, argsList))
 
     @staticmethod
     def domainNameIsPrivate(domainName):
@@ -227,6 +358,97 @@ class Util:
                 return False
 
 
+class TrashReaper:
+
+    # move directory into the trash directory of its filesystem and return immediately, a detached process deletes it
+    # the trash directory is "STATE_DIR/trash" if it is in the same filesystem, or else "<mount-point>/.robust_layer_trash-<uid>",
+    # or "<parent-directory>/.robust_layer_trash-<uid>" if the former is not writable, the latter two are removed once empty
+    # the reaper process is not killed when we exit and does not delay our exit, trash directories are recorded in the state database,
+    # leftovers (of killed reapers) in all of them are deleted when the first directory is trashed by a process
+
+    TRASH_DIR_NAME = ".robust_layer_trash"
+
+    _lock = threading.Lock()
+    _trashDirSet = set()
+    _bSwept = False
+
+    @classmethod
+    def trash(cls, path):
+        # returns False if path can't be moved into trash, the caller should delete it by itself
+        path = os.path.abspath(path)
+        for trashDir in cls._getTrashDirCandidates(path):
+            try:
+                os.makedirs(trashDir, mode=0o700, exist_ok=True)
+                st = os.lstat(trashDir)
+                if st.st_uid != os.getuid() or not stat.S_ISDIR(st.st_mode):
+                    continue                                    # not created by us
+                tmpDir = tempfile.mkdtemp(dir=trashDir)
+            except OSError:
+                continue
+            try:
+                os.rename(path, os.path.join(tmpDir, "x"))
+            except OSError:
+                shutil.rmtree(tmpDir, ignore_errors=True)        # it may have been swept by another process
+                continue
+            cls._reap(trashDir, tmpDir)
+            return True
+        return False
+
+    @classmethod
+    def _reap(cls, trashDir, tmpDir):
+        with cls._lock:
+            if trashDir not in cls._trashDirSet:
+                cls._trashDirSet.add(trashDir)
+                with StateDb() as db:
+                    db.addTrashDir(trashDir)
+            if not cls._bSwept:
+                cls._bSwept = True
+                cls._sweep()
+        cls._spawnReaper(trashDir, [tmpDir])
+
+    @classmethod
+    def _sweep(cls):
+        # entries being deleted by another reaper may be deleted again, it does no harm
+        with StateDb() as db:
+            for trashDir in db.getTrashDirs():
+                try:
+                    fnList = os.listdir(trashDir)
+                except FileNotFoundError:
+                    db.removeTrashDir(trashDir)
+                    continue
+                except OSError:
+                    continue
+                if len(fnList) > 0:
+                    cls._spawnReaper(trashDir, [os.path.join(trashDir, x) for x in fnList])
+
+    @classmethod
+    def _getTrashDirCandidates(cls, path):
+        from . import STATE_DIR
+
+        ret = []
+        try:
+            os.makedirs(STATE_DIR, exist_ok=True)
+            if os.stat(STATE_DIR).st_dev == os.stat(os.path.dirname(path)).st_dev:
+                ret.append(os.path.join(STATE_DIR, "trash"))
+        except OSError:
+            pass
+
+        mountPoint = os.path.dirname(path)
+        while not os.path.ismount(mountPoint):
+            mountPoint = os.path.dirname(mountPoint)
+        fn = "%s-%d" % (cls.TRASH_DIR_NAME, os.getuid())
+        ret.append(os.path.join(mountPoint, fn))
+        ret.append(os.path.join(os.path.dirname(path), fn))
+        return ret
+
+    @staticmethod
+    def _spawnReaper(trashDir, pathList):
+        # the reaper is put in background by shell and is in a new session, so it's detached from us, no zombie is left either
+        # trash directory is removed if it is empty, rmdir fails harmlessly if another process is using it
+        script = "(d=\"$1\"; shift; rm -rf \"$@\"; rmdir \"$d\") </dev/null >/dev/null 2>&1 &"
+        subprocess.run(["/bin/sh", "-c", script, "sh", trashDir] + pathList, start_new_session=True)
+
+
 class TempChdir:
 
     def __init__(self, dirname):
@@ -238,3 +460,157 @@ class TempChdir:
 
     def __exit__(self, type, value, traceback):
         os.chdir(self.olddir)
+
+
+class DestLock:
+
+    # serialize operations on the same destination, across threads and processes
+    # a caller who has waited for an identical in-flight operation gets its result (self.done is True) instead of doing it again
+    # the operation can store a one-line string in self.result, the caller who has waited for it gets the same self.result
+    # the lock file records "<serial>\n<result>\n<key>" of the last finished operation, key is empty if it failed
+
+    def __init__(self, dest, key):
+        self._path = os.path.join(LOCK_DIR, hashlib.sha1(os.path.abspath(dest).encode("utf-8")).hexdigest())
+        self._key = key
+        self._fd = None
+        self._serial = 0
+        self.done = False
+        self.result = ""
+
+    def __enter__(self):
+        Util.prepareLockDir()
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self._serial = self._readRecord()[0]
+        except BlockingIOError:
+            oldSerial = self._readRecord()[0]
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            self._serial, result, key = self._readRecord()
+            self.done = (self._serial != oldSerial and key == self._key)
+            if self.done:
+                self.result = result
+        return self
+
+    def __exit__(self, type, value, traceback):
+        try:
+            if not self.done:
+                assert "\n" not in self.result
+                buf = ("%d\n%s\n%s" % (self._serial + 1, self.result, self._key if type is None else "")).encode("utf-8")
+                os.ftruncate(self._fd, 0)
+                os.pwrite(self._fd, buf, 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def _readRecord(self):
+        buf = os.pread(self._fd, 4096, 0).decode("utf-8")
+        if buf == "":
+            return (0, "", "")
+        serial, result, key = buf.split("\n", 2)
+        return (int(serial), result, key)
+
+
+class Slot:
+
+    # occupy one of the "maxNum" slots whose names begin with "prefix", wait if all of them are occupied, 0 means no limit
+    # slots are lock files in LOCK_DIR so they are shared by all the processes
+
+    def __init__(self, prefix, maxNum):
+        self._prefix = prefix
+        self._maxNum = maxNum
+        self._fd = None
+
+    def __enter__(self):
+        self._fd = Slot.occupy(self._prefix, self._maxNum)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        Slot.release(self._fd)
+        self._fd = None
+
+    @staticmethod
+    def occupy(prefix, maxNum):
+        Util.prepareLockDir()
+        while True:
+            for i in (range(0, maxNum) if maxNum > 0 else itertools.count()):
+                fd = os.open(os.path.join(LOCK_DIR, prefix + str(i)), os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            time.sleep(RETRY_WAIT)
+
+    @staticmethod
+    def count(prefix):
+        # returns number of the occupied slots
+        # locks are read from /proc/locks instead of being probed, probing would make a concurrent occupy() skip free slots
+        # all the slots are considered occupied if /proc/locks is not available
+        try:
+            with open("/proc/locks") as f:
+                lockSet = set([x.split()[5] for x in f if x.split()[1] == "FLOCK"])      # "1: FLOCK  ADVISORY  WRITE 1234 fe:00:5678 0 EOF"
+        except OSError:
+            lockSet = None
+
+        ret = 0
+        for fn in os.listdir(LOCK_DIR):
+            if fn.startswith(prefix) and fn[len(prefix):].isdigit():
+                if lockSet is None:
+                    ret += 1
+                    continue
+                try:
+                    st = os.stat(os.path.join(LOCK_DIR, fn))
+                except FileNotFoundError:
+                    continue
+                if "%02x:%02x:%d" % (os.major(st.st_dev), os.minor(st.st_dev), st.st_ino) in lockSet:
+                    ret += 1
+        return ret
+
+    @staticmethod
+    def release(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class NetSlot:
+
+    # occupy a connection slot of the host and a global one, wait if all of them are occupied
+    # self.bandwidth is the share of BANDWIDTH_LIMIT and BANDWIDTH_LIMIT_PER_HOST for this operation, 0 means no limit
+    # the limit is divided by the number of running operations when entering, callers enter again for every attempt so the share follows the load
+
+    def __init__(self, host):
+        self._host = host
+        self._fdList = []
+        self.bandwidth = 0
+
+    def __enter__(self):
+        from . import BANDWIDTH_LIMIT, BANDWIDTH_LIMIT_PER_HOST, MAX_CONNECTIONS, MAX_CONNECTIONS_PER_HOST
+
+        try:
+            # always occupy host slot first to avoid deadlock
+            if self._host is not None:
+                hostPrefix = "slot-host-%s-" % (self._host)
+                self._fdList.append(Slot.occupy(hostPrefix, MAX_CONNECTIONS_PER_HOST))
+            self._fdList.append(Slot.occupy("slot-global-", MAX_CONNECTIONS))
+
+            shareList = []
+            if BANDWIDTH_LIMIT > 0:
+                shareList.append(BANDWIDTH_LIMIT // max(Slot.count("slot-global-"), 1))
+            if BANDWIDTH_LIMIT_PER_HOST > 0 and self._host is not None:
+                shareList.append(BANDWIDTH_LIMIT_PER_HOST // max(Slot.count(hostPrefix), 1))
+            if len(shareList) > 0:
+                self.bandwidth = max(min(shareList), 1)
+        except BaseException:
+            self._release()
+            raise
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._release()
+
+    def _release(self):
+        for fd in self._fdList:
+            Slot.release(fd)
+        self._fdList = []
@@ -25,39 +25,49 @@
 
 import os
 import re
-import sys
 import time
 import subprocess
+import collections
 import urllib.parse
-from . import TIMEOUT, RETRY_WAIT
-from ._util import Util, ProcessStuckError
+import concurrent.futures
+from . import RETRY_WAIT
+from . import progress
+from . import git_maintenance
+from . import _ssh
+from ._util import Util, ProcessStuckError, NetSlot
 
 
-def additional_environ():
-    return {
+def additional_environ(host=None):
+    ret = {
         "GIT_HTTP_LOW_SPEED_LIMIT": "1024",
-        "GIT_HTTP_LOW_SPEED_TIME": "60",            # we don't use TIMEOUT as git network operation is not "continuable"
-        "GIT_HTTP_CONNECT_TIMEOUT": str(TIMEOUT),   # only has effect for patched git (https://stackoverflow.com/questions/28180013/can-you-specify-a-timeout-to-git-fetch)
+        "GIT_HTTP_LOW_SPEED_TIME": "60",                            # we don't use TIMEOUT as git network operation is not "continuable"
+        "GIT_HTTP_CONNECT_TIMEOUT": str(Util.getTimeout(host)),     # only has effect for patched git (https://stackoverflow.com/questions/28180013/can-you-specify-a-timeout-to-git-fetch)
     }
+    ret.update(_ssh.environ())                                      # GIT_SSH_COMMAND with ControlMaster, see SSH_MULTIPLEX
+    return ret
 
 
-def clone(*args):
+def clone(*args, jobs=None):
     assert not any(x in os.environ for x in additional_environ())
 
-    _doGitNetOp("clone", list(args))
+    _doGitNetOp("clone", _jobsParam(jobs, args) + list(args))
 
 
-def fetch(*args):
+def fetch(*args, jobs=None):
+    # "jobs" is the number of submodules or remotes fetched in parallel ("--recurse-submodules", "--multiple", "--all")
+    # the failed submodules or remotes are retried by themselves, see _doGitNetOp()
     assert not any(x in os.environ for x in additional_environ())
 
-    _doGitNetOp("fetch", list(args))
+    _doGitNetOp("fetch", _jobsParam(jobs, args) + list(args))
+    git_maintenance._autoNotifyPull(None)
 
 
-def pull(*args):
+def pull(*args, jobs=None):
     assert not any(x in os.environ for x in additional_environ())
     assert not any(x in ["-r", "--rebase", "--no-rebase"] for x in args)
 
-    _doGitNetOp("pull", ["--rebase"] + list(args))
+    _doGitNetOp("pull", ["--rebase"] + _jobsParam(jobs, args) + list(args))
+    git_maintenance._autoNotifyPull(None)
 
 
 def push(*args):
@@ -70,15 +80,32 @@ class PrivateUrlNotExistError(Exception):
     pass
 
 
-def _doGitNetOp(action, cmdList):
+def _jobsParam(jobs, args):
+    if jobs is None:
+        return []
+    assert not any(re.fullmatch("(-j|--jobs)(=.*)?", x) for x in args)
+    return ["--jobs=%d" % (jobs)]
+
+
+def _doGitNetOp(action, cmdList, workDir=None):
     # Util.cmdListExec() use pipe to do advanced process, we add "--progress" so that progress can still be displayed
     # "--quiet" would take priority if specified by user
-    if sys.stderr.isatty() and "--progress" not in cmdList:
+    if progress._wanted() and "--progress" not in cmdList:
         cmdList.insert(0, "--progress")
 
+    gitCmd = ["/usr/bin/git"]
+    if workDir is not None:
+        gitCmd += ["-C", workDir]
+
     while True:
         try:
-            Util.cmdListExec(["/usr/bin/git", action] + cmdList, Util.mergeDict(os.environ, additional_environ()))
+            urlList = _getRemoteUrls(action, cmdList, workDir)
+            hostSet = set([Util.urlGetHost(x) for x in urlList])
+            host = hostSet.pop() if len(hostSet) == 1 else None
+            for x in urlList:
+                _ssh.checkMaster(x)
+            with NetSlot(host):
+                Util.cmdListExec(gitCmd + [action] + cmdList, Util.mergeDict(os.environ, additional_environ(host)), host=host)
             break
         except ProcessStuckError:
             time.sleep(RETRY_WAIT)
@@ -96,9 +123,78 @@ def _doGitNetOp(action, cmdList):
             # always retry for public domain name failure of any reason, abort opertaion when private domain name does not exist
             _checkPrivateDomainNotExist(e)
 
+            if action == "fetch":
+                # partial failure: the superproject is fetched, only the failed submodules need to be retried
+                # the fetch is done only if no remote failed
+                nameList = _getFailedSubmodules(e)
+                remoteList = list(collections.OrderedDict.fromkeys(re.findall("^error: [Cc]ould not fetch '?([^'\\s]+)'?", e.stdout, re.M)))
+                if len(nameList) > 0:
+                    _fetchSubmodules(cmdList, workDir, nameList)
+                    if len(remoteList) == 0:
+                        break
+
+                # partial failure: only the failed remotes need to be retried
+                # note: options must be in "--option=value" form so that they can be separated from remote names
+                if len(remoteList) > 0:
+                    cmdList = [x for x in cmdList if x.startswith("-") and x not in ["--all", "--multiple"]] + ["--multiple"] + remoteList
+
             time.sleep(RETRY_WAIT)
 
 
+def _getRemoteUrls(action, cmdList, workDir):
+    # returns urls of the remote repositories, remote names are resolved by "git ls-remote --get-url"
+    # the first non-option argument is the repository, the others are refspecs (or directory for clone), except for "--multiple"
+    argList = [x for x in cmdList if not x.startswith("-")]
+    if action == "clone":
+        return [x for x in argList if Util.urlGetHost(x) is not None][:1]
+
+    gitCmd = ["/usr/bin/git"]
+    if workDir is not None:
+        gitCmd += ["-C", workDir]
+    try:
+        if "--all" in cmdList:
+            remoteList = Util.cmdCall(*gitCmd, "remote").split("\n")
+        elif "--multiple" in cmdList:
+            remoteList = argList
+        else:
+            remoteList = argList[:1]
+        if len(remoteList) == 0:
+            return [Util.cmdCall(*gitCmd, "ls-remote", "--get-url")]         # the default remote
+        return [Util.cmdCall(*gitCmd, "ls-remote", "--get-url", x) for x in remoteList if x != ""]
+    except subprocess.CalledProcessError:
+        return []                   # no remote, the real operation would fail and report it
+
+
+def _getFailedSubmodules(e):
+    m = re.search("^Errors during submodule fetch:\n((?:\t.*\n?)+)", e.stdout, re.M)
+    if m is None:
+        return []
+    # a submodule is listed once for each remote of the superproject when fetching several remotes
+    return list(collections.OrderedDict.fromkeys([x.strip() for x in m.group(1).split("\n") if x.strip() != ""]))
+
+
+def _fetchSubmodules(cmdList, workDir, nameList):
+    topDir = Util.cmdCall("/usr/bin/git", "-C", (workDir if workDir is not None else "."), "rev-parse", "--show-toplevel")
+    cmdList = [x for x in cmdList if x.startswith("-") and x != "--multiple"]      # remote names of superproject are meaningless for submodules
+
+    jobs = 1
+    for x in cmdList:
+        m = re.fullmatch("--jobs=([0-9]+)", x)
+        if m is not None:
+            jobs = int(m.group(1))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futureList = []
+        for name in nameList:
+            try:
+                path = Util.cmdCall("/usr/bin/git", "-C", topDir, "config", "-f", ".gitmodules", "submodule.%s.path" % (name))
+            except subprocess.CalledProcessError:
+                path = name
+            futureList.append(executor.submit(progress._inherit(_doGitNetOp), "fetch", list(cmdList), os.path.join(topDir, path)))
+        for f in futureList:
+            f.result()
+
+
 def _checkPrivateDomainNotExist(e):
     # note: we are matching the output of a pty, take control characters into consideration
 
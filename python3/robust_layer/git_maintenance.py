@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+# git_maintenance.py - incremental maintenance of git repositories
+#
+# Copyright (c) 2019-2020 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import os
+import re
+import threading
+import subprocess
+from ._util import Util, Slot
+from ._state import StateDb
+
+
+# maintenance is needed when any of the thresholds is reached
+PULL_THRESHOLD = 50
+LOOSE_OBJECT_THRESHOLD = 1000
+PACK_THRESHOLD = 20
+
+
+def notify_pull(dest_directory, background=True):
+    # called after the repository is pulled or fetched, do maintenance if needed
+    # dest_directory can be the work tree or the git directory, pull count is recorded for the latter so that a repository has only one counter
+    dest_directory = Util.cmdCall("/usr/bin/git", "-C", dest_directory, "rev-parse", "--absolute-git-dir")
+    with StateDb() as db:
+        pulls = db.increaseGitPullCount(dest_directory)
+    if pulls < PULL_THRESHOLD:
+        stats = _getObjectStats(dest_directory)
+        if stats["count"] < LOOSE_OBJECT_THRESHOLD and stats["packs"] < PACK_THRESHOLD:
+            return
+
+    if background:
+        threading.Thread(target=run, args=(dest_directory,), daemon=True).start()
+    else:
+        run(dest_directory)
+
+
+def _autoNotifyPull(dest_directory):
+    # called by robust_layer.git (dest_directory is None, the repository is in current directory) and robust_layer.simple_git
+    # maintenance thread dies with the process, the unfinished maintenance is done again when next pull
+    from . import GIT_MAINTENANCE
+
+    if GIT_MAINTENANCE:
+        notify_pull(dest_directory if dest_directory is not None else ".")
+
+
+def run(dest_directory):
+    # all the tasks are incremental, they're done with idle IO priority
+    # the destination is not locked, git's own locking is enough and updating the repository should never wait for maintenance
+    # a failed task is not retried until another PULL_THRESHOLD pulls
+    from . import GIT_MAINTENANCE_JOBS
+
+    with Slot("slot-git-maintenance-", GIT_MAINTENANCE_JOBS):
+        try:
+            stats = _getObjectStats(dest_directory)
+
+            # pack loose objects and delete them
+            if stats["count"] >= LOOSE_OBJECT_THRESHOLD:
+                _gitCall(dest_directory, "repack", "-d", "-q")
+
+            # consolidate small packs
+            if stats["packs"] >= PACK_THRESHOLD:
+                _gitCall(dest_directory, "multi-pack-index", "write")
+                _gitCall(dest_directory, "multi-pack-index", "expire")
+                _gitCall(dest_directory, "multi-pack-index", "repack", "--batch-size=%d" % (_getRepackBatchSize(stats)))
+
+            # speed up commit walking
+            _gitCall(dest_directory, "commit-graph", "write", "--reachable", "--split")
+        except subprocess.CalledProcessError as e:
+            print("Maintenance of git repository \"%s\" failed: %s" % (dest_directory, e))
+
+        with StateDb() as db:
+            db.resetGitPullCount(dest_directory)
+
+
+def _gitCall(dest_directory, *args):
+    cmdList = []
+    if os.path.exists("/usr/bin/ionice"):
+        cmdList += ["/usr/bin/ionice", "-c", "3"]
+    cmdList += ["/usr/bin/nice", "-n", "19", "/usr/bin/git", "-C", dest_directory] + list(args)
+    Util.cmdCall(*cmdList)
+
+
+def _getObjectStats(dest_directory):
+    # returns "count", "size", "in-pack", "packs", "size-pack", ... of "git count-objects -v", sizes are in KiB
+    ret = dict()
+    try:
+        out = Util.cmdCall("/usr/bin/git", "-C", dest_directory, "count-objects", "-v")
+    except subprocess.CalledProcessError:
+        return {"count": 0, "packs": 0}
+    for m in re.finditer("^(\\S+): (\\d+)$", out, re.M):
+        ret[m.group(1)] = int(m.group(2))
+    return ret
+
+
+def _getRepackBatchSize(stats):
+    # packs smaller than the average size are combined together
+    return max(stats.get("size-pack", 0) * 1024 // max(stats["packs"], 1), 1)
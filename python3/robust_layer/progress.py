@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# progress.py - structured progress events
+#
+# Copyright (c) 2019-2020 Fpemud <fpemud@sina.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+import re
+import sys
+import queue
+import threading
+import collections
+
+
+# an external command is started, "attempt" begins from 1 and increases when the same command is started again (retry)
+AttemptEvent = collections.namedtuple("AttemptEvent", ["cmd", "attempt"])
+
+# progress of the running command
+#   tool:  "git", "wget", "rsync" or "svn"
+#   phase: such as "Receiving objects" (git), "download" (wget), "transfer" (rsync), "update" (svn)
+#   unit:  "bytes", "objects" or "files", done/total are counted in it, total is None if unknown
+#   rate:  bytes per second, or None
+#   eta:   seconds, or None
+ProgressEvent = collections.namedtuple("ProgressEvent", ["tool", "phase", "done", "total", "unit", "rate", "eta"])
+
+# the command is finished, "stuck" is True if it is terminated by stuck check
+FinishEvent = collections.namedtuple("FinishEvent", ["cmd", "returncode", "stuck"])
+
+
+class listen:
+
+    # receive events of all the operations in the current thread, echo controls whether raw output is still written to stdout
+    #
+    # example:
+    #   with robust_layer.progress.listen(callback, echo=False):
+    #       robust_layer.simple_git.pull(...)
+
+    def __init__(self, callback, echo=True):
+        self.callback = callback
+        self.echo = echo
+        self._attemptDict = dict()
+        self._old = None
+
+    def __enter__(self):
+        self._old = getattr(_local, "listener", None)
+        _local.listener = self
+        return self
+
+    def __exit__(self, type, value, traceback):
+        _local.listener = self._old
+
+
+def iter_events(func, *args, echo=False, **kwargs):
+    # run func(*args, **kwargs) in a separate thread and yield its events, exception of func is re-raised at the end
+    #
+    # example:
+    #   for event in robust_layer.progress.iter_events(robust_layer.wget.exec, url):
+    #       ...
+
+    q = queue.Queue()
+    endMark = object()
+    excList = []
+
+    def _run():
+        try:
+            with listen(q.put, echo):
+                func(*args, **kwargs)
+        except BaseException as e:
+            excList.append(e)
+        finally:
+            q.put(endMark)
+
+    t = threading.Thread(target=_run, daemon=True)
+    t.start()
+    while True:
+        item = q.get()
+        if item is endMark:
+            break
+        yield item
+    t.join()
+
+    if len(excList) > 0:
+        raise excList[0]
+
+
+_local = threading.local()
+
+
+def _wanted():
+    # whether the progress output of the tools should be enabled
+    listener = getattr(_local, "listener", None)
+    return sys.stderr.isatty() or listener is not None
+
+
+def _inherit(func):
+    # make func, which is to be run in another thread, send events to the listener of the current thread
+    listener = getattr(_local, "listener", None)
+
+    def _run(*args, **kwargs):
+        if listener is None:
+            return func(*args, **kwargs)
+        old = getattr(_local, "listener", None)
+        _local.listener = listener
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.listener = old
+
+    return _run
+
+
+class _Relay:
+
+    # used by Util._communicate(), write output to stdout and/or parse it into events
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._listener = getattr(_local, "listener", None)
+        self._buf = b''
+        self._total = None
+
+        if isinstance(cmd, str):
+            self._tool = cmd.split()[0]
+        else:
+            self._tool = cmd[0]
+        self._tool = self._tool.split("/")[-1]
+
+        if self._listener is not None:
+            key = str(cmd)
+            attempt = self._listener._attemptDict.get(key, 0) + 1
+            self._listener._attemptDict[key] = attempt
+            self._listener.callback(AttemptEvent(cmd, attempt))
+
+    def feed(self, data):
+        if self._listener is None or self._listener.echo:
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+
+        if self._listener is not None:
+            # progress lines are ended by "\r"
+            lineList = re.split(b"[\r\n]", self._buf + data)
+            self._buf = lineList.pop()
+            for line in lineList:
+                line = re.sub("\x1b\\[[0-9;]*[A-Za-z]", "", line.decode("utf-8", errors="replace"))
+                event = self._parse(line)
+                if event is not None:
+                    self._listener.callback(event)
+
+    def finish(self, returncode, stuck=False):
+        if self._listener is not None:
+            self._listener.callback(FinishEvent(self._cmd, returncode, stuck))
+
+    def _parse(self, line):
+        if self._tool == "git":
+            # "Receiving objects:  45% (450/1000), 1.20 MiB | 500.00 KiB/s"
+            m = re.search("^(?:remote: )?([A-Za-z ]+):\\s+\\d+% \\((\\d+)/(\\d+)\\)(?:, [\\d.]+ \\S+ \\| ([\\d.]+ \\S+)/s)?", line)
+            if m is not None:
+                rate = _parseSize(m.group(4)) if m.group(4) is not None else None
+                return ProgressEvent("git", m.group(1), int(m.group(2)), int(m.group(3)), "objects", rate, None)
+            return None
+
+        if self._tool == "wget":
+            # "Length: 12345 (12K) [application/x-gzip]"
+            m = re.search("^Length: (\\d+)", line)
+            if m is not None:
+                self._total = int(m.group(1))
+                return None
+            # "file.tar.gz         45%[=======>        ]   1.20M   500KB/s    eta 3s"
+            m = re.search("(\\d+)%\\[[^\\]]*\\]\\s+([\\d.,]+[KMGT]?)\\s+(?:([\\d.,]+[KMGT]?B)/s|--\\.-KB/s)\\s+(?:eta (.*)|in .*)?$", line)
+            if m is not None:
+                rate = _parseSize(m.group(3)) if m.group(3) is not None else None
+                eta = _parseDuration(m.group(4)) if m.group(4) is not None else None
+                return ProgressEvent("wget", "download", _parseSize(m.group(2)), self._total, "bytes", rate, eta)
+            return None
+
+        if self._tool == "rsync":
+            # "  1,234,567  45%  1.23MB/s    0:00:03 (xfr#1, to-chk=0/1)", shown with "--progress" or "--info=progress2"
+            m = re.search("^\\s*([\\d,]+)\\s+(\\d+)%\\s+([\\d.]+[kKMGT]?B)/s\\s+(\\d+:\\d\\d:\\d\\d)", line)
+            if m is not None:
+                done = int(m.group(1).replace(",", ""))
+                percent = int(m.group(2))
+                total = done * 100 // percent if percent > 0 else None
+                return ProgressEvent("rsync", "transfer", done, total, "bytes", _parseSize(m.group(3)), _parseDuration(m.group(4)))
+            return None
+
+        if self._tool == "svn":
+            # "A    path/to/file", svn does not report total
+            if re.search("^[ADUCGER][ADUCGER ]?[ B]?[ C]?\\s+\\S", line) is not None:
+                self._total = (self._total or 0) + 1
+                return ProgressEvent("svn", "update", self._total, None, "files", None, None)
+            return None
+
+        return None
+
+
+def _parseSize(s):
+    # "1.20 MiB", "1.20M", "500KB", "1.23kB" -> number of bytes (all the units are treated as power of 1024)
+    m = re.fullmatch("([\\d.,]+)\\s*([kKMGT]?)(?:i?B)?", s)
+    if m is None:
+        return None
+    value = float(m.group(1).replace(",", ""))
+    return int(value * (1024 ** " KMGT".index(m.group(2).upper() or " ")))
+
+
+def _parseDuration(s):
+    # "3s", "1m 5s", "2h 3m", "1d 2h" (wget) or "0:00:03" (rsync) -> seconds
+    m = re.fullmatch("(\\d+):(\\d\\d):(\\d\\d)", s.strip())
+    if m is not None:
+        return int(m.group(1)) * 3600 + int(m.group(2)) * 60 + int(m.group(3))
+    ret = 0
+    for value, unit in re.findall("(\\d+)([dhms])", s):
+        ret += int(value) * {"d": 86400, "h": 3600, "m": 60, "s": 1}[unit]
+    return ret
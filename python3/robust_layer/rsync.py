@@ -23,16 +23,29 @@
 # THE SOFTWARE.
 
 
+import re
 import time
 import subprocess
-from . import TIMEOUT, RETRY_WAIT
-from ._util import Util, ProcessStuckError
+from . import RETRY_WAIT
+from ._util import Util, ProcessStuckError, DestLock, NetSlot
 
 
 def exec(*args):
+    # the last argument is the destination, concurrent transfers of the same source to it are coalesced
+    with DestLock(args[-1], "\0".join(args)) as lock:
+        if not lock.done:
+            _exec(args)
+
+
+def _exec(args):
+    host = Util.argsGetHost(args)
     while True:
         try:
-            Util.cmdListExec(["/usr/bin/rsync", "--timeout=%d" % (TIMEOUT)] + list(args))
+            with NetSlot(host) as slot:
+                cmdList = ["/usr/bin/rsync", "--timeout=%d" % (Util.getTimeout(host))]
+                if slot.bandwidth > 0 and not any(re.fullmatch("--bwlimit(=.*)?", x) for x in args):
+                    cmdList.append("--bwlimit=%d" % (max(slot.bandwidth // 1024, 1)))     # unit of --bwlimit is KiB/s
+                Util.cmdListExec(cmdList + list(args), host=host)
             break
         except ProcessStuckError:
             time.sleep(RETRY_WAIT)
@@ -24,16 +24,91 @@
 
 
 import os
+import stat
+import errno
+import fcntl
+import ctypes
 import shutil
+import platform
+import tempfile
+import concurrent.futures
+from ._util import Util
 
 
-def mv(src, dst):
-    if os.path.isdir(dst):          # shutil.move() won't overwrite directory, so we delete it first
+def mv(src, dst, background_delete=False):
+    if os.path.isdir(src) and not os.path.islink(src) and os.path.isdir(dst) and not os.path.islink(dst):
+        replace_dir(src, dst, background_delete)
+        return
+    if os.path.isdir(dst):          # os.rename() won't overwrite directory, so we delete it first
         if os.path.islink(dst):
             os.remove(dst)
         else:
-            shutil.rmtree(dst)
-    shutil.move(src, dst)
+            Util.forceDelete(dst, background_delete)
+    try:
+        os.rename(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        cp(src, dst)
+        rm(src, background_delete)
+
+
+def cp(src, dst, background_delete=False):
+    # reflink is used if the filesystem supports it, then copy_file_range() and sendfile(), files in directory are copied in parallel
+    # the copy is made beside dst and then replaces dst atomically, so dst is never incomplete
+    dstDir = os.path.dirname(os.path.abspath(dst))
+    prefix = ".%s." % (os.path.basename(dst))
+
+    if os.path.isdir(src) and not os.path.islink(src):
+        tmpDir = tempfile.mkdtemp(dir=dstDir, prefix=prefix)
+        try:
+            _copyTree(src, tmpDir)
+        except BaseException:
+            shutil.rmtree(tmpDir)
+            raise
+        replace_dir(tmpDir, dst, background_delete)
+        return
+
+    fd, tmpFile = tempfile.mkstemp(dir=dstDir, prefix=prefix)
+    os.close(fd)
+    try:
+        if os.path.islink(src):
+            os.remove(tmpFile)
+            os.symlink(os.readlink(src), tmpFile)
+        else:
+            _copyFile(src, tmpFile)
+        if os.path.isdir(dst) and not os.path.islink(dst):
+            Util.forceDelete(dst, background_delete)
+        os.replace(tmpFile, dst)
+    except BaseException:
+        rm(tmpFile)
+        raise
+
+
+def replace_dir(src, dst, background_delete=False):
+    # replace directory dst by src with renameat2(RENAME_EXCHANGE), readers see either the old or the new tree but never a missing one
+    # the old tree is deleted afterwards, in background if background_delete is True
+    if not os.path.lexists(dst):
+        mv(src, dst)
+        return
+
+    try:
+        _renameExchange(src, dst)
+    except OSError as e:
+        if e.errno == errno.EXDEV:
+            # copy to the filesystem of dst first
+            cp(src, dst, background_delete)
+            rm(src, background_delete)
+            return
+        if e.errno in [errno.ENOSYS, errno.EINVAL]:
+            # renameat2() or RENAME_EXCHANGE is not supported by the kernel or the filesystem
+            Util.forceDelete(dst, background_delete)
+            os.rename(src, dst)
+            return
+        raise
+
+    # src is the old tree now
+    Util.forceDelete(src, background_delete)
 
 
 def ln(target, link_path):
@@ -43,16 +118,107 @@ def ln(target, link_path):
     os.symlink(target, link_path)
 
 
-def rm(path):
+def rm(path, background=False):
+    # background: directory is moved into trash and deleted by a detached process, see robust_layer._util.TrashReaper
     if os.path.islink(path):
         os.remove(path)
     elif os.path.isfile(path):
         os.remove(path)
     elif os.path.isdir(path):
-        shutil.rmtree(path)
+        Util.forceDelete(path, background)
     elif os.path.exists(path):
         # other type of file, such as device node
         os.remove(path)
     else:
         # path does not exist, do nothing
         pass
+
+
+FICLONE = 0x40049409
+
+RENAME_EXCHANGE = 2
+
+AT_FDCWD = -100
+
+SYS_RENAMEAT2 = {
+    "x86_64": 316,
+    "aarch64": 276,
+    "i686": 353,
+    "armv7l": 382,
+}
+
+
+def _renameExchange(path1, path2):
+    libc = ctypes.CDLL(None, use_errno=True)
+    if hasattr(libc, "renameat2"):
+        ret = libc.renameat2(AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2), RENAME_EXCHANGE)
+    elif platform.machine() in SYS_RENAMEAT2:
+        ret = libc.syscall(SYS_RENAMEAT2[platform.machine()], AT_FDCWD, os.fsencode(path1), AT_FDCWD, os.fsencode(path2), RENAME_EXCHANGE)
+    else:
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    if ret != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), path1, None, path2)
+
+
+def _copyTree(src, dst):
+    # directories are created in walking order, files are copied in parallel, directory metadata is copied at last
+    dirList = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        futureList = []
+        for root, dirs, files in os.walk(src):
+            dstRoot = os.path.join(dst, os.path.relpath(root, src))
+            os.makedirs(dstRoot, exist_ok=True)
+            dirList.append((root, dstRoot))
+            for fn in files + [x for x in dirs if os.path.islink(os.path.join(root, x))]:
+                srcPath = os.path.join(root, fn)
+                dstPath = os.path.join(dstRoot, fn)
+                if os.path.islink(srcPath):
+                    os.symlink(os.readlink(srcPath), dstPath)
+                    shutil.copystat(srcPath, dstPath, follow_symlinks=False)
+                else:
+                    futureList.append(executor.submit(_copyFile, srcPath, dstPath))
+        for f in futureList:
+            f.result()
+    for srcPath, dstPath in reversed(dirList):
+        shutil.copystat(srcPath, dstPath)
+
+
+def _copyFile(src, dst):
+    if not stat.S_ISREG(os.stat(src).st_mode):
+        raise shutil.SpecialFileError("%s is not a regular file" % (src))
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            size = os.fstat(fsrc.fileno()).st_size
+            for func in [_copyDataByCopyFileRange, _copyDataBySendfile]:
+                try:
+                    func(fsrc.fileno(), fdst.fileno(), size)
+                    break
+                except OSError as e:
+                    if e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+                        raise
+                    os.lseek(fsrc.fileno(), 0, os.SEEK_SET)
+                    os.lseek(fdst.fileno(), 0, os.SEEK_SET)
+                    os.ftruncate(fdst.fileno(), 0)
+            else:
+                shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+
+
+def _copyDataByCopyFileRange(srcFd, dstFd, size):
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+    while os.copy_file_range(srcFd, dstFd, max(size, 1024 * 1024)) > 0:
+        pass
+
+
+def _copyDataBySendfile(srcFd, dstFd, size):
+    offset = 0
+    while True:
+        n = os.sendfile(dstFd, srcFd, offset, max(size, 1024 * 1024))
+        if n == 0:
+            break
+        offset += n
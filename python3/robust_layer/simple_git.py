@@ -24,33 +24,93 @@
 
 
 import os
-import sys
 import time
 import subprocess
+import concurrent.futures
 from . import RETRY_WAIT
-from ._util import Util, ProcessStuckError
+from . import progress
+from . import git_maintenance
+from . import _ssh
+from ._util import Util, ProcessStuckError, DestLock, NetSlot
+from ._state import StateDb
 from .git import additional_environ, _checkPrivateDomainNotExist
 
 
 def clean(dest_directory):
     Util.cmdCall("/usr/bin/git", "-C", dest_directory, "reset", "--hard")  # revert any modifications
     Util.cmdCall("/usr/bin/git", "-C", dest_directory, "clean", "-xfd")    # delete untracked files
+    if os.path.exists(os.path.join(dest_directory, ".gitmodules")):
+        Util.cmdCall("/usr/bin/git", "-C", dest_directory, "submodule", "foreach", "--recursive", "git reset --hard && git clean -xfd")
 
 
-def clone(dest_directory, url, quiet=False):
+def clone(dest_directory, url, quiet=False, recurse_submodules=False, jobs=1):
     assert not any(x in os.environ for x in additional_environ())
 
+    with DestLock(dest_directory, "clone %s %s" % (url, recurse_submodules)) as lock:
+        if not lock.done:
+            _clone(dest_directory, url, quiet)
+            if recurse_submodules:
+                _updateSubmodules(dest_directory, quiet, jobs)
+
+
+def pull(dest_directory, reclone_on_failure=False, url=None, quiet=False, recurse_submodules=False, jobs=1, skip_unchanged=False):
+    # submodules are updated after the superproject, "jobs" of them in parallel
+    # each submodule is retried by itself, so a flaky submodule host won't cause the superproject to be pulled again
+    # skip_unchanged: the remote head is recorded in the sync-state index, pull (including clean()) is skipped if it has not changed since then
+    assert not any(x in os.environ for x in additional_environ())
+
+    if reclone_on_failure:
+        assert url is not None
+    else:
+        assert url is None
+
+    with DestLock(dest_directory, "pull %s %s" % (url, recurse_submodules)) as lock:
+        if lock.done:
+            return
+        if skip_unchanged and _isUnchanged(dest_directory, url):
+            return
+        _pull(dest_directory, reclone_on_failure, url, quiet)
+        if recurse_submodules:
+            _updateSubmodules(dest_directory, quiet, jobs)
+        if skip_unchanged:
+            _recordSyncState(dest_directory, url)
+
+    # maintenance is done after the lock is released, so that concurrent pulls of the same destination won't wait for it
+    git_maintenance._autoNotifyPull(dest_directory)
+
+
+def precheck(dest_directories, jobs=4):
+    # returns the directories that need to be pulled, others have not changed since they were pulled with skip_unchanged=True
+    # remote heads are queried in parallel, at most "jobs" queries for each host, and only once for the same url
+    with StateDb() as db:
+        recordDict = {x: db.getSyncState(x) for x in dest_directories}
+
+    queryList = sorted(set([(x[0], x[1]) for x in recordDict.values() if x is not None]))
+    headDict = dict(zip(queryList, Util.runPerHost(_gitLsRemote, queryList, jobs)))
+
+    ret = []
+    for d in dest_directories:
+        record = recordDict[d]
+        if record is None or headDict[(record[0], record[1])] != record[2] or not os.path.isdir(os.path.join(d, ".git")):
+            ret.append(d)
+    return ret
+
+
+def _clone(dest_directory, url, quiet):
     if quiet:
         quietArg = "-q"
-    elif sys.stderr.isatty():
+    elif progress._wanted():
         quietArg = "--progress"    # Util.shellExec() use pipe to do advanced process, we add "--progress" so that progress can still be displayed
     else:
         quietArg = ""
 
+    host = Util.urlGetHost(url)
     while True:
         try:
             cmd = "/usr/bin/git clone %s \"%s\" \"%s\"" % (quietArg, url, dest_directory)
-            Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ()))
+            _ssh.checkMaster(url)
+            with NetSlot(host):
+                Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ(host)), host=host)
             break
         except ProcessStuckError:
             time.sleep(RETRY_WAIT)
@@ -65,21 +125,16 @@ def clone(dest_directory, url, quiet=False):
             time.sleep(RETRY_WAIT)
 
 
-def pull(dest_directory, reclone_on_failure=False, url=None, quiet=False):
-    assert not any(x in os.environ for x in additional_environ())
-
-    if reclone_on_failure:
-        assert url is not None
-    else:
-        assert url is None
-
+def _pull(dest_directory, reclone_on_failure, url, quiet):
     if quiet:
         quietArg = "-q"
-    elif sys.stderr.isatty():
+    elif progress._wanted():
         quietArg = "--progress"    # Util.shellExec() use pipe to do advanced process, we add "--progress" so that progress can still be displayed
     else:
         quietArg = ""
 
+    host = Util.urlGetHost(url) if url is not None else None
+
     mode = "pull"
     while reclone_on_failure:
         if not os.path.exists(dest_directory):
@@ -98,7 +153,10 @@ def pull(dest_directory, reclone_on_failure=False, url=None, quiet=False):
             clean(dest_directory)
             try:
                 cmd = "/usr/bin/git -C \"%s\" pull --rebase --no-stat %s" % (dest_directory, quietArg)
-                Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ()))
+                if url is not None:
+                    _ssh.checkMaster(url)
+                with NetSlot(host):
+                    Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ(host)), host=host)
                 break
             except ProcessStuckError:
                 time.sleep(1.0)
@@ -125,7 +183,9 @@ def pull(dest_directory, reclone_on_failure=False, url=None, quiet=False):
             Util.forceDelete(dest_directory)
             try:
                 cmd = "/usr/bin/git clone %s \"%s\" \"%s\"" % (quietArg, url, dest_directory)
-                Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ()))
+                _ssh.checkMaster(url)
+                with NetSlot(host):
+                    Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ(host)), host=host)
                 break
             except ProcessStuckError:
                 time.sleep(1.0)
@@ -144,6 +204,93 @@ def pull(dest_directory, reclone_on_failure=False, url=None, quiet=False):
         assert False
 
 
+def _updateSubmodules(dest_directory, quiet, jobs):
+    if quiet:
+        quietArg = "-q"
+    elif progress._wanted():
+        quietArg = "--progress"    # Util.shellExec() use pipe to do advanced process, we add "--progress" so that progress can still be displayed
+    else:
+        quietArg = ""
+
+    Util.cmdCall("/usr/bin/git", "-C", dest_directory, "submodule", "sync", "--recursive")
+    Util.cmdCall("/usr/bin/git", "-C", dest_directory, "submodule", "init")          # modifies .git/config, so it can't be done in parallel
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futureList = [executor.submit(progress._inherit(_updateOneSubmodule), dest_directory, x, quietArg) for x in _gitGetSubmodulePaths(dest_directory)]
+        for f in futureList:
+            f.result()
+
+
+def _updateOneSubmodule(dest_directory, path, quietArg):
+    while True:
+        try:
+            cmd = "/usr/bin/git -C \"%s\" submodule update --init --recursive --force %s -- \"%s\"" % (dest_directory, quietArg, path)
+            with NetSlot(None):
+                Util.shellExec(cmd, Util.mergeDict(os.environ, additional_environ()))
+            break
+        except ProcessStuckError:
+            time.sleep(RETRY_WAIT)
+        except subprocess.CalledProcessError as e:
+            # terminated by signal, no retry needed
+            if e.returncode > 128:
+                raise
+
+            # unrecoverable error: private domain name does not exists (see comments in robust_layer.git)
+            _checkPrivateDomainNotExist(e)
+
+            time.sleep(RETRY_WAIT)
+
+
+def _gitGetSubmodulePaths(dirName):
+    if not os.path.exists(os.path.join(dirName, ".gitmodules")):
+        return []
+    try:
+        out = Util.cmdCall("/usr/bin/git", "-C", dirName, "config", "-f", ".gitmodules", "--get-regexp", "^submodule\\..*\\.path$")
+    except subprocess.CalledProcessError:
+        return []                   # no submodule in .gitmodules
+    return [x.split(" ", 1)[1] for x in out.split("\n") if x != ""]
+
+
+def _isUnchanged(dest_directory, url):
+    with StateDb() as db:
+        record = db.getSyncState(dest_directory)
+        if record is not None and (url is None or url == record[0]) and os.path.isdir(os.path.join(dest_directory, ".git")):
+            if _gitLsRemote(record[0], record[1]) == record[2]:
+                return True
+        db.removeSyncState(dest_directory)
+        return False
+
+
+def _recordSyncState(dest_directory, url):
+    if url is None:
+        url = _gitGetUrl(dest_directory)
+    try:
+        branch = Util.cmdCall("/usr/bin/git", "-C", dest_directory, "symbolic-ref", "--short", "HEAD")
+        ref = Util.cmdCall("/usr/bin/git", "-C", dest_directory, "config", "branch.%s.merge" % (branch))
+        head = Util.cmdCall("/usr/bin/git", "-C", dest_directory, "rev-parse", "@{upstream}")
+    except subprocess.CalledProcessError:
+        return                      # detached HEAD or no upstream, can't be prechecked
+    with StateDb() as db:
+        db.setSyncState(dest_directory, url, ref, head)
+
+
+def _gitLsRemote(url, ref):
+    # returns None if failed, the caller would do the real operation which has retry and error handling
+    host = Util.urlGetHost(url)
+    try:
+        with NetSlot(host):
+            out = subprocess.run(["/usr/bin/git", "ls-remote", url, ref], env=Util.mergeDict(os.environ, additional_environ(host)),
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        return None
+    if out.returncode != 0:
+        return None
+    for line in out.stdout.split("\n"):
+        if line.endswith("\t" + ref):
+            return line.split("\t")[0]
+    return None
+
+
 def _gitGetUrl(dirName):
     gitDir = os.path.join(dirName, ".git")
     cmdStr = "/usr/bin/git --git-dir=\"%s\" --work-tree=\"%s\" config --get remote.origin.url" % (gitDir, dirName)
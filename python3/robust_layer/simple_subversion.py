@@ -28,7 +28,8 @@ import re
 import time
 import subprocess
 from . import RETRY_WAIT
-from ._util import Util, ProcessStuckError, TempChdir
+from ._util import Util, ProcessStuckError, TempChdir, DestLock, NetSlot
+from ._state import StateDb
 
 
 def clean(dest_directory):
@@ -38,6 +39,54 @@ def clean(dest_directory):
 
 
 def checkout(dest_directory, url, quiet=False):
+    with DestLock(dest_directory, "checkout %s" % (url)) as lock:
+        if not lock.done:
+            _checkout(dest_directory, url, quiet)
+
+
+def update(dest_directory, recheckout_on_failure=False, url=None, quiet=False, skip_unchanged=False):
+    # skip_unchanged: the last changed revision is recorded in the sync-state index, update (including clean()) is skipped if it has not changed since then
+    if recheckout_on_failure:
+        assert url is not None
+    else:
+        assert url is None
+
+    with DestLock(dest_directory, "update %s" % (url)) as lock:
+        if lock.done:
+            return
+        if not skip_unchanged:
+            _update(dest_directory, recheckout_on_failure, url, quiet)
+            return
+
+        with StateDb() as db:
+            record = db.getSyncState(dest_directory)
+            if record is not None and (url is None or url == record[0]) and os.path.isdir(os.path.join(dest_directory, ".svn")):
+                if _svnGetRemoteRevision(record[0]) == record[2]:
+                    return
+            db.removeSyncState(dest_directory)
+
+        _update(dest_directory, recheckout_on_failure, url, quiet)
+        _recordSyncState(dest_directory, url)
+
+
+def precheck(dest_directories, jobs=4):
+    # returns the directories that need to be updated, others have not changed since they were updated with skip_unchanged=True
+    # remote revisions are queried in parallel, at most "jobs" queries for each host, and only once for the same url
+    with StateDb() as db:
+        recordDict = {x: db.getSyncState(x) for x in dest_directories}
+
+    queryList = sorted(set([(x[0],) for x in recordDict.values() if x is not None]))
+    revDict = dict(zip(queryList, Util.runPerHost(_svnGetRemoteRevision, queryList, jobs)))
+
+    ret = []
+    for d in dest_directories:
+        record = recordDict[d]
+        if record is None or revDict[(record[0],)] != record[2] or not os.path.isdir(os.path.join(d, ".svn")):
+            ret.append(d)
+    return ret
+
+
+def _checkout(dest_directory, url, quiet):
     if quiet:
         # FIXME
         quietArg = ""
@@ -47,7 +96,8 @@ def checkout(dest_directory, url, quiet=False):
     while True:
         try:
             cmd = "/usr/bin/svn checkout %s \"%s\" \"%s\"" % (quietArg, url, dest_directory)
-            Util.shellExec(cmd)
+            with NetSlot(Util.urlGetHost(url)):
+                Util.shellExec(cmd)
             break
         except ProcessStuckError:
             time.sleep(RETRY_WAIT)
@@ -58,12 +108,7 @@ def checkout(dest_directory, url, quiet=False):
             time.sleep(RETRY_WAIT)
 
 
-def update(dest_directory, recheckout_on_failure=False, url=None, quiet=False):
-    if recheckout_on_failure:
-        assert url is not None
-    else:
-        assert url is None
-
+def _update(dest_directory, recheckout_on_failure, url, quiet):
     if quiet:
         # FIXME
         quietArg = ""
@@ -89,7 +134,8 @@ def update(dest_directory, recheckout_on_failure=False, url=None, quiet=False):
             try:
                 with TempChdir(dest_directory):
                     cmd = "/usr/bin/svn update %s" % (quietArg)
-                    Util.shellExec(cmd)
+                    with NetSlot(Util.urlGetHost(url) if url is not None else None):
+                        Util.shellExec(cmd)
                 break
             except ProcessStuckError:
                 time.sleep(1.0)
@@ -101,7 +147,8 @@ def update(dest_directory, recheckout_on_failure=False, url=None, quiet=False):
             Util.forceDelete(dest_directory)
             try:
                 cmd = "/usr/bin/svn checkout %s \"%s\" \"%s\"" % (quietArg, url, dest_directory)
-                Util.shellExec(cmd)
+                with NetSlot(Util.urlGetHost(url)):
+                    Util.shellExec(cmd)
                 break
             except subprocess.CalledProcessError as e:
                 if e.returncode > 128:
@@ -111,6 +158,27 @@ def update(dest_directory, recheckout_on_failure=False, url=None, quiet=False):
             assert False
 
 
+def _recordSyncState(dest_directory, url):
+    if url is None:
+        url = _svnGetUrl(dest_directory)
+    rev = Util.cmdCall("/usr/bin/svn", "info", "--show-item", "last-changed-revision", dest_directory)
+    with StateDb() as db:
+        db.setSyncState(dest_directory, url, "", rev)
+
+
+def _svnGetRemoteRevision(url):
+    # returns None if failed, the caller would do the real operation which has retry and error handling
+    try:
+        with NetSlot(Util.urlGetHost(url)):
+            out = subprocess.run(["/usr/bin/svn", "info", "--non-interactive", "--show-item", "last-changed-revision", "-r", "HEAD", url],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=60)
+    except subprocess.TimeoutExpired:
+        return None
+    if out.returncode != 0:
+        return None
+    return out.stdout.strip()
+
+
 def _svnGetUrl(dirName):
     ret = Util.cmdCall("/usr/bin/svn", "info", dirName)
     m = re.search("^URL: (.*)$", ret, re.M)
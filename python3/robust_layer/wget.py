@@ -23,23 +23,43 @@
 # THE SOFTWARE.
 
 
+import os
 import re
-import sys
-from . import TIMEOUT, RETRY_WAIT
-from ._util import Util
+import tempfile
+import subprocess
+import collections
+import concurrent.futures
+from . import RETRY_WAIT
+from . import progress
+from ._util import Util, NetSlot, DestLock
+from ._state import StateDb
 
 
 SOURCE_CONTINUABLE = 1
 SOURCE_NOT_CONTINUABLE = 2
 SOURCE_DETECT_CONTINUABLE = 3
 
+BATCH_TRIES = 3                     # tries of each url in one "wget -i", exec_batch() retries failed urls by itself
 
-def additional_param(source_continuable=SOURCE_CONTINUABLE):
+
+def additional_param(source_continuable=SOURCE_CONTINUABLE, host=None):
+    timeout = Util.getTimeout(host)
     if source_continuable == SOURCE_CONTINUABLE:
-        return ["-t", "0", "-w", str(RETRY_WAIT), "--random-wait", "-T", str(TIMEOUT)]
+        return ["-t", "0", "-w", str(RETRY_WAIT), "--random-wait", "-T", str(timeout)]
     elif source_continuable == SOURCE_NOT_CONTINUABLE:
         # we don't modify "--read-timeout" here so that the connection is kept as long as possible
-        return ["-t", "0", "-w", str(RETRY_WAIT), "--random-wait", "--dns-timeout=%d" % (TIMEOUT), "--connect-timeout=%d" % (TIMEOUT)]
+        return ["-t", "0", "-w", str(RETRY_WAIT), "--random-wait", "--dns-timeout=%d" % (timeout), "--connect-timeout=%d" % (timeout)]
+    else:
+        assert False
+
+
+def _batchParam(source_continuable, host):
+    # same as additional_param(), but "--wait" applies between all the retrievals of "wget -i", so only retries wait
+    timeout = Util.getTimeout(host)
+    if source_continuable == SOURCE_CONTINUABLE:
+        return ["-t", str(BATCH_TRIES), "--waitretry=%d" % (RETRY_WAIT), "-T", str(timeout)]
+    elif source_continuable == SOURCE_NOT_CONTINUABLE:
+        return ["-t", str(BATCH_TRIES), "--waitretry=%d" % (RETRY_WAIT), "--dns-timeout=%d" % (timeout), "--connect-timeout=%d" % (timeout)]
     else:
         assert False
 
@@ -53,11 +73,11 @@ def exec(*args, source_continuable=SOURCE_CONTINUABLE):
 
     for x in args:
         assert x != "--random-wait"
-        assert not re.fullmatch("(-t|--tries|-w|--wait|-T|--timetout|--dns-timeout|--connect-timeout|--read-timeout)(=.*)?", x)
+        assert not re.fullmatch("(-t|--tries|-w|--wait|-T|--timeout|--dns-timeout|--connect-timeout|--read-timeout)(=.*)?", x)
     args = list(args)
 
     # Util.cmdListExec() use pipe to do advanced process, here is to ensure progress is not affected
-    if sys.stderr.isatty():
+    if progress._wanted():
         bFound = False
         for i in range(0, len(args)):
             if args[i].startswith("--progress=") and not args[i].endswith(":force"):
@@ -66,7 +86,188 @@ def exec(*args, source_continuable=SOURCE_CONTINUABLE):
         if not bFound:
             args.insert(0, "--progress=bar:force")
 
-    Util.cmdListExec(["/usr/bin/wget"] + additional_param(source_continuable) + args)
+    host = Util.argsGetHost(args)
+    with NetSlot(host) as slot:
+        cmdList = ["/usr/bin/wget"] + additional_param(source_continuable, host)
+        if slot.bandwidth > 0 and not any(re.fullmatch("--limit-rate(=.*)?", x) for x in args):
+            cmdList.append("--limit-rate=%d" % (slot.bandwidth))
+        return Util.cmdListExec(cmdList + args, host=host)
+
+
+def exec_conditional(url, dest_file, *args, source_continuable=SOURCE_CONTINUABLE):
+    # download url to dest_file only if it has changed, returns True if downloaded, False if not modified
+    # validators (ETag, Last-Modified) of the last download are stored in the state database and sent as conditional request
+    # dest_file is replaced atomically, it is not touched at all when not modified
+
+    for x in args:
+        assert not re.fullmatch("(-O|--output-document|-N|--timestamping|-c|--continue)(=.*)?", x)
+
+    with DestLock(dest_file, "exec_conditional %s" % (url)) as lock:
+        if lock.done:
+            return lock.result != "not-modified"
+
+        with StateDb() as db:
+            record = db.getHttpValidators(url, dest_file)
+
+        headerArgs = []
+        if record is not None and os.path.isfile(dest_file) and os.path.getsize(dest_file) == record[2]:
+            if record[0] is not None:
+                headerArgs.append("--header=If-None-Match: %s" % (record[0]))
+            if record[1] is not None:
+                headerArgs.append("--header=If-Modified-Since: %s" % (record[1]))
+
+        tmpFile = dest_file + ".robust_layer.tmp"
+        try:
+            out = exec("-S", "-O", tmpFile, *headerArgs, *args, url, source_continuable=source_continuable)
+        except subprocess.CalledProcessError as e:
+            Util.forceDelete(tmpFile)
+            if len(headerArgs) > 0 and re.search("^  HTTP/\\S+ 304", e.stdout, re.M) is not None:
+                lock.result = "not-modified"
+                return False
+            raise
+        except BaseException:
+            Util.forceDelete(tmpFile)
+            raise
+
+        # response headers of the last request, there're several requests if redirected
+        headers = re.split("^  HTTP/", out, flags=re.M)[-1]
+        m = re.search("^  ETag: (.*?)\\s*$", headers, re.M | re.I)
+        etag = m.group(1) if m is not None else None
+        m = re.search("^  Last-Modified: (.*?)\\s*$", headers, re.M | re.I)
+        lastModified = m.group(1) if m is not None else None
+
+        os.replace(tmpFile, dest_file)
+        with StateDb() as db:
+            if etag is not None or lastModified is not None:
+                db.setHttpValidators(url, dest_file, etag, lastModified, os.path.getsize(dest_file))
+            else:
+                db.removeHttpValidators(url, dest_file)
+        return True
+
+
+BatchResult = collections.namedtuple("BatchResult", ["url", "path", "ok", "attempts"])
+
+
+def exec_batch(manifest, dest_dir, *args, parallel=4, retries=3, source_continuable=SOURCE_CONTINUABLE):
+    # download all the urls in manifest into dest_dir, files are named by wget, BatchResult.path is where the file is saved
+    # urls of the same host are downloaded by "wget -i" so that connection is reused, at most "parallel" wget processes are running
+    # failed urls are retried by themselves, partial files are continued if source is continuable
+    # files are downloaded into a staging directory and moved into dest_dir when finished, so failed urls leave nothing in dest_dir
+    # returns list of BatchResult in the order of manifest
+    assert source_continuable in [SOURCE_CONTINUABLE, SOURCE_NOT_CONTINUABLE]
+    for x in args:
+        assert not re.fullmatch("(-t|--tries|--waitretry|-T|--timeout|--dns-timeout|--connect-timeout|--read-timeout|-i|--input-file|-O|--output-document|-P|--directory-prefix|-c|--continue|-nv|--no-verbose|-x|--force-directories)(=.*)?", x)
+
+    dest_dir = os.path.normpath(dest_dir)
+    stageDir = tempfile.mkdtemp(dir=dest_dir, prefix=".robust_layer-wget-")
+    try:
+        attemptDict = collections.OrderedDict((x, 0) for x in manifest)
+        pathDict = dict()
+        urlDirDict = dict()         # work directory of failed url that has its partial file in it
+        while True:
+            todoList = [x for x in attemptDict if x not in pathDict and attemptDict[x] <= retries]
+            if len(todoList) == 0:
+                break
+
+            if any(attemptDict[x] > 0 for x in todoList):
+                # retry each url by itself
+                chunkList = [[x] for x in todoList]
+            else:
+                # split urls of each host into at most "parallel" chunks
+                hostDict = dict()
+                for url in todoList:
+                    hostDict.setdefault(Util.urlGetHost(url), []).append(url)
+                chunkList = []
+                for urlList in hostDict.values():
+                    n = min(parallel, len(urlList))
+                    chunkList += [urlList[i::n] for i in range(0, n)]
+
+            # every chunk has its own work directory, so wget processes never see files of each other
+            dirList = []
+            for urlList in chunkList:
+                if len(urlList) == 1 and urlList[0] in urlDirDict:
+                    dirList.append(urlDirDict.pop(urlList[0]))
+                else:
+                    dirList.append(tempfile.mkdtemp(dir=stageDir))
+
+            with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+                futureList = []
+                for urlList, workDir in zip(chunkList, dirList):
+                    bContinue = (len(os.listdir(workDir)) > 0)
+                    futureList.append(executor.submit(progress._inherit(_execChunk), urlList, workDir, args, bContinue, source_continuable))
+                for urlList, workDir, f in zip(chunkList, dirList, futureList):
+                    for url, path in f.result().items():
+                        pathDict[url] = _moveIntoDir(path, dest_dir, pathDict.values())
+
+                    # partial file is kept for "wget -c" only if it surely belongs to the failed url
+                    failedList = [x for x in urlList if x not in pathDict]
+                    if source_continuable == SOURCE_CONTINUABLE and len(failedList) == 1 and len(os.listdir(workDir)) <= 1:
+                        urlDirDict[failedList[0]] = workDir
+                    else:
+                        Util.forceDelete(workDir)
+
+            for url in todoList:
+                attemptDict[url] += 1
+    finally:
+        Util.forceDelete(stageDir)
+
+    return [BatchResult(x, pathDict.get(x), x in pathDict, attemptDict[x]) for x in manifest]
+
+
+def _execChunk(urlList, dest_dir, args, bContinue, source_continuable):
+    # returns dict of url -> saved file
+    host = Util.urlGetHost(urlList[0])
+    with tempfile.NamedTemporaryFile(mode="w", prefix="robust_layer-wget-", suffix=".txt") as f:
+        f.write("".join([x + "\n" for x in urlList]))
+        f.flush()
+
+        cmdList = ["-nv", "-nd", "-P", dest_dir, "-i", f.name]
+        if bContinue and source_continuable == SOURCE_CONTINUABLE:
+            cmdList.append("-c")
+
+        with NetSlot(host) as slot:
+            if slot.bandwidth > 0 and not any(re.fullmatch("--limit-rate(=.*)?", x) for x in args):
+                cmdList.append("--limit-rate=%d" % (slot.bandwidth))
+            try:
+                out = Util.cmdListExec(["/usr/bin/wget"] + _batchParam(source_continuable, host) + cmdList + list(args), host=host)
+            except subprocess.CalledProcessError as e:
+                if e.returncode > 128:
+                    raise                    # terminated by signal, no retry needed
+                out = e.stdout
+
+    # succeeded: "2020-01-01 00:00:00 URL:http://host/a.txt [5/5] -> "dest/a.txt" [1]"
+    # failed:    "http://host/b.txt:\n2020-01-01 00:00:00 ERROR 404: Not Found."
+    # the url printed is the final one if redirected, and wget may print an url in its own form, those lines can't be matched by url
+    ret = dict()
+    failedSet = set(re.findall("^(\\S+):\n\\S+ \\S+ ERROR ", out, re.M))
+    unmatchedList = []
+    for url, path in re.findall("URL: ?(\\S+) \\[[^\\]]*\\] -> \"(.*)\" \\[\\d+\\]$", out, re.M):
+        if url in urlList:
+            ret[url] = path
+        else:
+            unmatchedList.append(path)
+
+    # urls are processed in order and each one has at most one saved file, so unmatched lines belong to the unknown urls in order if their numbers are equal
+    # otherwise some url failed silently (such as "Connection refused") and the files can't be attributed, they're dropped and the urls are retried by themselves
+    unknownList = [x for x in urlList if x not in ret and x not in failedSet]
+    if len(unmatchedList) == len(unknownList):
+        ret.update(zip(unknownList, unmatchedList))
+    else:
+        for path in unmatchedList:
+            Util.forceDelete(path)
+    return ret
+
+
+def _moveIntoDir(path, dirpath, excludePaths):
+    # files downloaded in one batch never overwrite each other, the same name gets a suffix just like wget does
+    fn = os.path.basename(path)
+    ret = os.path.join(dirpath, fn)
+    i = 1
+    while ret in excludePaths:
+        ret = os.path.join(dirpath, "%s.%d" % (fn, i))
+        i += 1
+    os.replace(path, ret)
+    return ret
 
 
 class PrivateUrlNotExistError(Exception):